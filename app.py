@@ -1,8 +1,16 @@
-from flask import Flask, request
+from flask import Flask, request, Response
 import os
-from datetime import datetime
+from datetime import datetime, date, timedelta
 import re
 import json
+import threading
+import queue
+import time
+import atexit
+import signal
+import sys
+from xml.sax.saxutils import escape
+from collections import defaultdict
 
 app = Flask(__name__)
 
@@ -25,14 +33,21 @@ except Exception as e:
 try:
     import gspread
     from google.oauth2.service_account import Credentials
+    from gspread.urls import DRIVE_FILES_API_V3_URL
     SHEETS_AVAILABLE = True
 except Exception as e:
     print(f"Warning: Google Sheets not available: {e}")
     SHEETS_AVAILABLE = False
 
+# Cached Sheets client and worksheet (shared across requests)
+_client = None
+_worksheet = None
+_index_worksheet = None
+_lock = threading.Lock()
+
 # Google Sheets setup
-def get_sheets_client():
-    """Initialize Google Sheets client"""
+def load_credentials():
+    """Load service account credentials once at startup"""
     if not SHEETS_AVAILABLE:
         return None
     
@@ -41,7 +56,7 @@ def get_sheets_client():
         creds_json = os.environ.get('GOOGLE_SHEETS_CREDENTIALS')
         if creds_json:
             creds_dict = json.loads(creds_json)
-            creds = Credentials.from_service_account_info(
+            return Credentials.from_service_account_info(
                 creds_dict,
                 scopes=[
                     'https://www.googleapis.com/auth/spreadsheets',
@@ -50,263 +65,698 @@ def get_sheets_client():
             )
         else:
             # For local development, use credentials file
-            creds = Credentials.from_service_account_file(
+            return Credentials.from_service_account_file(
                 'credentials.json',
                 scopes=[
                     'https://www.googleapis.com/auth/spreadsheets',
                     'https://www.googleapis.com/auth/drive'
                 ]
             )
-        
-        client = gspread.authorize(creds)
-        return client
     except Exception as e:
-        print(f"Error initializing sheets client: {e}")
+        print(f"Error loading sheets credentials: {e}")
         return None
 
-def get_or_create_sheet():
-    """Get or create the expense tracking spreadsheet"""
-    client = get_sheets_client()
-    if not client:
+_CREDS = load_credentials()
+
+def get_sheets_client():
+    """Initialize Google Sheets client (cached after first call)"""
+    global _client
+    if not _CREDS:
         return None
     
-    sheet_name = "ExpenseTracker"
+    if _client:
+        return _client
     
     try:
-        # Try to open existing spreadsheet
-        spreadsheet = client.open(sheet_name)
-        worksheet = spreadsheet.sheet1
-    except:
+        # Reusing the same credentials keeps google-auth's access token
+        _client = gspread.authorize(_CREDS)
+        return _client
+    except Exception as e:
+        print(f"Error initializing sheets client: {e}")
+        return None
+
+def get_or_create_sheet():
+    """Get or create the expense tracking spreadsheet (cached after first call)"""
+    global _worksheet
+    if _worksheet:
+        return _worksheet
+    
+    with _lock:
+        # Another thread may have opened it while we waited
+        if _worksheet:
+            return _worksheet
+        
+        client = get_sheets_client()
+        if not client:
+            return None
+        
+        sheet_name = "ExpenseTracker"
+        
         try:
-            # Create new spreadsheet
-            spreadsheet = client.create(sheet_name)
+            # Try to open existing spreadsheet
+            spreadsheet = client.open(sheet_name)
             worksheet = spreadsheet.sheet1
-            
-            # Set up headers
-            worksheet.update('A1:E1', [['Date', 'Description', 'Amount', 'Category', 'Timestamp']])
+        except gspread.SpreadsheetNotFound:
+            try:
+                # Create new spreadsheet
+                spreadsheet = client.create(sheet_name)
+                worksheet = spreadsheet.sheet1
+                
+                # Set up headers
+                worksheet.update('A1:E1', [['Date', 'Description', 'Amount', 'Category', 'Timestamp']])
+            except Exception as e:
+                print(f"Error creating sheet: {e}")
+                return None
+        except Exception as e:
+            # Transient failures (429/5xx, network) must not create a new
+            # spreadsheet or be cached; the next call tries again
+            print(f"Error opening sheet: {e}")
+            return None
+        
+        _worksheet = worksheet
+        return _worksheet
+
+# Helper sheet holding per-day, per-category totals for the last 31 days.
+# Sheets evaluates the QUERY server-side, so summaries read a small fixed-size
+# range instead of downloading every expense ever recorded.
+INDEX_SHEET_NAME = "Index"
+INDEX_FORMULA = (
+    "=QUERY('{sheet}'!A2:D, \"select A, D, sum(C) "
+    "where A >= '\"&TEXT(TODAY()-31, \"yyyy-mm-dd\")&\"' "
+    "group by A, D label A '', D '', sum(C) ''\", 0)"
+)
+
+def get_index_sheet():
+    """Get or create the Index sheet with the summary QUERY (cached after first call)"""
+    global _index_worksheet
+    if _index_worksheet:
+        return _index_worksheet
+    
+    worksheet = get_or_create_sheet()
+    if not worksheet:
+        return None
+    
+    with _lock:
+        if _index_worksheet:
+            return _index_worksheet
+        
+        spreadsheet = worksheet.spreadsheet
+        try:
+            index = spreadsheet.worksheet(INDEX_SHEET_NAME)
+        except gspread.WorksheetNotFound:
+            try:
+                index = spreadsheet.add_worksheet(INDEX_SHEET_NAME, rows=1000, cols=3)
+                index.update_acell('A1', INDEX_FORMULA.format(sheet=worksheet.title))
+            except Exception as e:
+                print(f"Error creating index sheet: {e}")
+                return None
         except Exception as e:
-            print(f"Error creating sheet: {e}")
+            print(f"Error opening index sheet: {e}")
             return None
+        
+        _index_worksheet = index
+        return _index_worksheet
+
+def reset_sheet_cache(error):
+    """Drop the cached client/worksheets if the error was an auth failure"""
+    global _client, _worksheet, _index_worksheet
+    response = getattr(error, 'response', None)
+    if getattr(response, 'status_code', None) == 401:
+        with _lock:
+            _client = None
+            _worksheet = None
+            _index_worksheet = None
+
+# Cache of Gemini categories keyed by normalized description
+CATEGORY_CACHE_FILE = 'categories.json'
+_category_cache = {}
+
+def _normalize_description(description):
+    """Lowercase and strip digits/punctuation so 'Coffee!' and 'coffee 2' share a key"""
+    return ' '.join(re.sub(r'[^a-z\s]', ' ', description.lower()).split())
+
+def _load_category_cache():
+    """Load categories cached by a previous process"""
+    if not os.path.exists(CATEGORY_CACHE_FILE):
+        return
+    
+    try:
+        with open(CATEGORY_CACHE_FILE) as f:
+            _category_cache.update(json.load(f))
+    except Exception as e:
+        print(f"Error loading category cache: {e}")
+
+def _save_category_cache():
+    """Persist cached categories to disk"""
+    if not _category_cache:
+        return
     
-    return worksheet
+    try:
+        with open(CATEGORY_CACHE_FILE, 'w') as f:
+            json.dump(dict(_category_cache), f)
+    except Exception as e:
+        print(f"Error saving category cache: {e}")
+
+_load_category_cache()
+atexit.register(_save_category_cache)
+
+# Keywords per category; rule_based_category checks them in order. Labels
+# match the ones offered to Gemini so both paths use the same names.
+CATEGORY_KEYWORDS = {
+    'Food': ['lunch', 'dinner', 'breakfast', 'coffee', 'restaurant', 'food', 'pizza',
+             'burger', 'meal', 'snack', 'cafe', 'starbucks'],
+    'Groceries': ['groceries', 'grocery'],
+    'Transport': ['uber', 'lyft', 'taxi', 'bus', 'train', 'gas', 'fuel', 'parking',
+                  'metro', 'subway', 'ride', 'transport', 'car', 'flight', 'plane'],
+    'Shopping': ['amazon', 'shopping', 'store', 'mall', 'clothes', 'clothing',
+                 'shoes', 'electronics', 'buy', 'purchase'],
+    'Entertainment': ['movie', 'cinema', 'concert', 'game', 'netflix', 'spotify',
+                      'entertainment', 'bar', 'club', 'party'],
+    'Bills': ['bill', 'rent', 'electric', 'water', 'internet', 'phone', 'utility',
+              'insurance', 'subscription'],
+    'Health': ['doctor', 'hospital', 'medicine', 'pharmacy', 'health', 'gym',
+               'fitness', 'medical', 'clinic'],
+}
+
+# Same keywords as sets for whole-word matching
+_CATEGORY_KEYWORD_SETS = {
+    category: frozenset(keywords) for category, keywords in CATEGORY_KEYWORDS.items()
+}
+
+# Filler words that don't change what a description is about
+_FILLER_WORDS = frozenset(['a', 'an', 'the', 'at', 'to', 'from', 'for', 'with',
+                           'in', 'on', 'of', 'my', 'our'])
 
 # AI categorization using Google Gemini
-def categorize_expense(description):
-    """Use Gemini to categorize the expense, fallback to rule-based"""
+def cached_category(description):
+    """Return a category without calling Gemini, or None if it needs the AI"""
+    key = _normalize_description(description)
+    
+    if not GEMINI_AVAILABLE:
+        return rule_based_category(description)
+    
+    # Confident only when the words hit exactly one category and nothing else
+    # qualifies them: 'gas bill' hits two categories, and the unknown word in
+    # 'chocolate bar' or 'uber eats' changes the meaning, so both go to Gemini
+    words = set(key.split()) - _FILLER_WORDS
+    matches = [
+        category for category, keywords in _CATEGORY_KEYWORD_SETS.items()
+        if not words.isdisjoint(keywords)
+    ]
+    if len(matches) == 1 and words <= _CATEGORY_KEYWORD_SETS[matches[0]]:
+        return matches[0]
+    
+    return _category_cache.get(key)
+
+def categorize_expenses(descriptions):
+    """Use one Gemini call to categorize several expenses, fallback to rule-based"""
     
     # If Gemini is available, use it
-    if GEMINI_AVAILABLE:
+    if GEMINI_AVAILABLE and descriptions:
         try:
-            prompt = f"""Categorize this expense into ONE word category: "{description}"
+            expenses = "\n".join(f'{i}. "{d}"' for i, d in enumerate(descriptions, 1))
+            prompt = f"""Categorize each of these expenses into ONE word category:
+{expenses}
 
 Common categories: Food, Transport, Shopping, Entertainment, Bills, Health, Education, Groceries, Other
 
-Respond with ONLY the category name, nothing else."""
+Respond with ONLY a JSON list of category names, one per expense, in the same order."""
             
             response = model.generate_content(prompt)
-            category = response.text.strip()
-            return category
+            
+            # Gemini sometimes wraps the JSON in a ```json fence
+            text = response.text.strip().strip('`')
+            if text.startswith('json'):
+                text = text[4:]
+            categories = [str(category).strip() for category in json.loads(text)]
+            if len(categories) != len(descriptions):
+                raise ValueError(f"expected {len(descriptions)} categories, got {len(categories)}")
+            
+            for description, category in zip(descriptions, categories):
+                key = _normalize_description(description)
+                if key:
+                    _category_cache[key] = category
+            return categories
         except Exception as e:
             print(f"Error with Gemini, using fallback: {e}")
     
-    # Fallback: Simple rule-based categorization
+    return [rule_based_category(description) for description in descriptions]
+
+def rule_based_category(description):
+    """Simple keyword-based categorization"""
     description_lower = description.lower()
     
-    # Food keywords
-    food_keywords = ['lunch', 'dinner', 'breakfast', 'coffee', 'restaurant', 'food', 'pizza', 
-                     'burger', 'meal', 'snack', 'groceries', 'grocery', 'cafe', 'starbucks']
-    
-    # Transport keywords
-    transport_keywords = ['uber', 'lyft', 'taxi', 'bus', 'train', 'gas', 'fuel', 'parking', 
-                          'metro', 'subway', 'ride', 'transport', 'car', 'flight', 'plane']
-    
-    # Shopping keywords
-    shopping_keywords = ['amazon', 'shopping', 'store', 'mall', 'clothes', 'clothing', 
-                         'shoes', 'electronics', 'buy', 'purchase']
-    
-    # Entertainment keywords
-    entertainment_keywords = ['movie', 'cinema', 'concert', 'game', 'netflix', 'spotify', 
-                              'entertainment', 'bar', 'club', 'party']
-    
-    # Bills keywords
-    bills_keywords = ['bill', 'rent', 'electric', 'water', 'internet', 'phone', 'utility', 
-                      'insurance', 'subscription']
-    
-    # Health keywords
-    health_keywords = ['doctor', 'hospital', 'medicine', 'pharmacy', 'health', 'gym', 
-                       'fitness', 'medical', 'clinic']
-    
     # Check each category
-    if any(keyword in description_lower for keyword in food_keywords):
-        return "Food"
-    elif any(keyword in description_lower for keyword in transport_keywords):
-        return "Transport"
-    elif any(keyword in description_lower for keyword in shopping_keywords):
-        return "Shopping"
-    elif any(keyword in description_lower for keyword in entertainment_keywords):
-        return "Entertainment"
-    elif any(keyword in description_lower for keyword in bills_keywords):
-        return "Bills"
-    elif any(keyword in description_lower for keyword in health_keywords):
-        return "Health"
-    else:
-        return "Other"
+    for category, keywords in CATEGORY_KEYWORDS.items():
+        if any(keyword in description_lower for keyword in keywords):
+            return category
+    
+    return "Other"
+
+# Matches "description amount" first, then "amount description"
+_RE_EXPENSE = re.compile(r'(.+?)\s+([\d.]+)|([\d.]+)\s+(.+)')
 
 # Parse expense from message
 def parse_expense(text):
     """Extract description and amount from text like 'Lunch 15.50'"""
-    # Try pattern: "description amount"
-    match = re.search(r'(.+?)\s+([\d.]+)\s*$', text.strip())
-    if match:
+    # Collapse whitespace so multi-line messages parse as one line
+    match = _RE_EXPENSE.fullmatch(' '.join(text.split()))
+    if not match:
+        return None, None
+    
+    if match.group(1) is not None:
+        # Pattern: "description amount"
         description = match.group(1).strip()
         amount = float(match.group(2))
-        return description, amount
-    
-    # Try pattern: "amount description"
-    match = re.search(r'^([\d.]+)\s+(.+)', text.strip())
-    if match:
-        amount = float(match.group(1))
-        description = match.group(2).strip()
-        return description, amount
+    else:
+        # Pattern: "amount description"
+        amount = float(match.group(3))
+        description = match.group(4).strip()
     
-    return None, None
+    return description, amount
+
+# Expenses waiting to be written to Google Sheets by the background flusher
+_pending = queue.Queue()
+FLUSH_MAX_ROWS = 100
+FLUSH_INTERVAL = 2  # seconds
+PENDING_FILE = 'pending_expenses.json'
+FLUSH_SHUTDOWN_TIMEOUT = 10  # seconds
+FLUSH_MAX_BACKOFF = 60  # seconds
+FLUSH_FAILURE_LIMIT = 3  # consecutive failures before saves are refused
+
+# Consecutive failed appends and the current retry delay
+_flush_failures = 0
+_flush_backoff = 0
+
+# Rows the flusher has taken off _pending but not yet written. Only the
+# flusher touches it until _save_pending has stopped the flusher at exit.
+_in_flight = []
+_stop_flusher = threading.Event()
 
 # Save expense to Google Sheets
 def save_expense(description, amount, category):
-    """Save expense to Google Sheets"""
+    """Queue expense for the next batched write to Google Sheets"""
     try:
-        worksheet = get_or_create_sheet()
-        if not worksheet:
+        # The flusher opens the sheet, so the webhook never waits on Sheets.
+        # Refuse when there are no credentials, or when writes keep failing
+        # so we don't keep promising saves that can't happen.
+        if not _CREDS or sheets_failing():
             return False
         
-        date = datetime.now().strftime('%Y-%m-%d')
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        # One clock read; the date is the first 10 chars of the ISO timestamp
+        now = datetime.now()
+        timestamp = now.isoformat(sep=' ', timespec='seconds')
+        day = timestamp[:10]
         
-        # Append new row
-        worksheet.append_row([date, description, amount, category, timestamp])
+        # Amount stays a number so Sheets can sum it without coercion
+        amount = float(amount)
+        # A category of None is filled in by the flusher's batched Gemini call
+        _pending.put([day, description, amount, category, timestamp])
+        if category:
+            _record_daily(now.date(), category, amount)
         return True
     except Exception as e:
         print(f"Error saving expense: {e}")
         return False
 
-# Get summary from Google Sheets
-def get_summary(period='today'):
-    """Get expense summary from Google Sheets"""
+def sheets_failing():
+    """True once the flusher has failed FLUSH_FAILURE_LIMIT appends in a row"""
+    return _flush_failures >= FLUSH_FAILURE_LIMIT
+
+def _flusher():
+    """Write queued expenses to Google Sheets in batches"""
+    global _flush_failures, _flush_backoff
+    while True:
+        # Wait for the first row unless a failed batch is waiting to be retried
+        while not _in_flight and not _stop_flusher.is_set():
+            try:
+                _in_flight.append(_pending.get(timeout=FLUSH_INTERVAL))
+            except queue.Empty:
+                pass
+        
+        if _stop_flusher.is_set() and not _in_flight and _pending.empty():
+            return
+        
+        # Collect more for up to FLUSH_INTERVAL; don't wait when shutting down
+        wait = 0 if _stop_flusher.is_set() else FLUSH_INTERVAL
+        deadline = time.monotonic() + wait
+        while len(_in_flight) < FLUSH_MAX_ROWS:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    _in_flight.append(_pending.get(timeout=remaining))
+                else:
+                    _in_flight.append(_pending.get_nowait())
+            except queue.Empty:
+                break
+        
+        rows = list(_in_flight)
+        
+        # Categorize uncached expenses together in a single Gemini call
+        uncategorized = [row for row in rows if row[3] is None]
+        if uncategorized:
+            categories = categorize_expenses([row[1] for row in uncategorized])
+            for row, category in zip(uncategorized, categories):
+                row[3] = category
+                _record_daily(date.fromisoformat(row[0]), category, row[2])
+        
+        try:
+            worksheet = get_or_create_sheet()
+            if not worksheet:
+                raise RuntimeError("worksheet unavailable")
+            
+            # One API call for the whole batch. RAW skips server-side parsing
+            # and keeps Date as text, which the Index QUERY compares against.
+            worksheet.append_rows(rows, value_input_option='RAW')
+        except Exception as e:
+            reset_sheet_cache(e)
+            
+            # Back off exponentially so retries don't eat into the same quota;
+            # only log when the delay changes, not on every capped retry
+            _flush_failures += 1
+            backoff = min(max(_flush_backoff * 2, FLUSH_INTERVAL), FLUSH_MAX_BACKOFF)
+            if backoff != _flush_backoff:
+                print(f"Error flushing {len(rows)} expenses, retrying every {backoff}s: {e}")
+            _flush_backoff = backoff
+            
+            # The batch stays in _in_flight for the retry, or for
+            # _save_pending if we're shutting down
+            if _stop_flusher.wait(backoff):
+                return
+            continue
+        
+        if _flush_failures:
+            print(f"Flushed {len(rows)} expenses after {_flush_failures} failed attempts")
+            _flush_failures = 0
+            _flush_backoff = 0
+        
+        del _in_flight[:len(rows)]
+        # unfinished_tasks reaches 0 only once every saved row is in Sheets
+        for _ in rows:
+            _pending.task_done()
+
+def _save_pending():
+    """Flush what we can, then persist the rest to disk so a restart doesn't lose it"""
+    _stop_flusher.set()
+    _flusher_thread.join(FLUSH_SHUTDOWN_TIMEOUT)
+    
+    rows = list(_in_flight)
+    while True:
+        try:
+            rows.append(_pending.get_nowait())
+        except queue.Empty:
+            break
+    
+    if rows:
+        try:
+            with open(PENDING_FILE, 'w') as f:
+                json.dump(rows, f)
+            print(f"Saved {len(rows)} pending expenses to {PENDING_FILE}")
+        except Exception as e:
+            print(f"Error saving pending expenses: {e}")
+
+def _load_pending():
+    """Re-queue expenses persisted by a previous process"""
+    if not os.path.exists(PENDING_FILE):
+        return
+    
     try:
-        worksheet = get_or_create_sheet()
-        if not worksheet:
-            return [], 0
+        with open(PENDING_FILE) as f:
+            rows = json.load(f)
+        for row in rows:
+            _pending.put(row)
+        os.remove(PENDING_FILE)
+        print(f"Loaded {len(rows)} pending expenses from {PENDING_FILE}")
+    except Exception as e:
+        print(f"Error loading pending expenses: {e}")
+
+_load_pending()
+_flusher_thread = threading.Thread(target=_flusher, daemon=True)
+_flusher_thread.start()
+
+# In-memory running totals: {date: {category: amount}}. Summaries are served
+# from here; saves add to it directly, and the background refresher reloads it
+# from the Index sheet to pick up edits made in the spreadsheet itself.
+_daily = defaultdict(lambda: defaultdict(float))
+_daily_loaded = False
+_daily_lock = threading.Lock()
+SNAPSHOT_FILE = 'daily_totals.json'
+SNAPSHOT_INTERVAL = 3600  # seconds
+REFRESH_INTERVAL = 60  # seconds
+LOAD_RETRY_INTERVAL = 10  # seconds, until the first load succeeds
+_synced_modified_time = None
+
+def _record_daily(day, category, amount):
+    """Add a saved expense to the in-memory totals"""
+    with _daily_lock:
+        # Before the first load the row is still unflushed, so the load waits
+        # for it to reach Sheets and picks it up from there
+        if not _daily_loaded:
+            return
+        _daily[day][category] += amount
+
+def _replace_daily(daily, wait_for_flush=False):
+    """Swap in freshly loaded totals"""
+    global _daily_loaded
+    with _daily_lock:
+        # Totals read from Sheets miss rows that are queued or in flight, and
+        # replacing would drop them; try again once the queue has been flushed
+        if wait_for_flush and _pending.unfinished_tasks:
+            return False
+        _daily.clear()
+        _daily.update(daily)
+        _daily_loaded = True
+        return True
+
+def _spreadsheet_modified_time():
+    """Ask Drive when the spreadsheet last changed (a tiny metadata request)"""
+    worksheet = get_or_create_sheet()
+    if not worksheet:
+        return None
+    
+    spreadsheet = worksheet.spreadsheet
+    response = spreadsheet.client.request(
+        'get',
+        f'{DRIVE_FILES_API_V3_URL}/{spreadsheet.id}',
+        params={'fields': 'modifiedTime', 'supportsAllDrives': True}
+    )
+    return response.json().get('modifiedTime')
+
+def _load_daily(refresh=False):
+    """Populate the in-memory totals from the Index sheet (a Drive modifiedTime call plus one Index read)"""
+    global _synced_modified_time
+    try:
+        index = get_index_sheet()
+        if not index:
+            return False if refresh else _load_daily_snapshot()
         
-        # Get all records
-        records = worksheet.get_all_records()
+        # Read the modification time first so edits made during the read
+        # are picked up by the next refresh
+        modified_time = _spreadsheet_modified_time()
         
-        # Filter by period
-        today = datetime.now().date()
-        filtered = []
+        # Get [Date, Category, Amount] totals for the last 31 days
+        rows = index.get('A1:C', value_render_option='UNFORMATTED_VALUE')
         
-        for record in records:
+        daily = defaultdict(lambda: defaultdict(float))
+        for row in rows:
+            # Skip short or non-date rows without paying for a failed parse
+            if len(row) < 3:
+                continue
+            date_str, category, amount = row[:3]
+            if not (isinstance(date_str, str) and len(date_str) == 10 and date_str[4] == '-'):
+                continue
+            
             try:
-                record_date = datetime.strptime(record['Date'], '%Y-%m-%d').date()
-                
-                if period == 'today' and record_date == today:
-                    filtered.append(record)
-                elif period == 'week' and (today - record_date).days <= 7:
-                    filtered.append(record)
-                elif period == 'month' and (today - record_date).days <= 30:
-                    filtered.append(record)
-            except:
+                row_date = date.fromisoformat(date_str)
+                daily[row_date][category] += float(amount)
+            except (ValueError, TypeError):
                 continue
         
+        if not _replace_daily(daily, wait_for_flush=True):
+            return False
+        _synced_modified_time = modified_time
+        return True
+    except Exception as e:
+        print(f"Error loading daily totals: {e}")
+        reset_sheet_cache(e)
+        return False if refresh else _load_daily_snapshot()
+
+def _refresh_daily():
+    """Reload the totals only if the spreadsheet changed since the last sync"""
+    if not _daily_loaded:
+        _load_daily()
+        return
+    
+    try:
+        modified_time = _spreadsheet_modified_time()
+    except Exception as e:
+        print(f"Error checking spreadsheet for changes: {e}")
+        reset_sheet_cache(e)
+        return
+    
+    if modified_time and modified_time != _synced_modified_time:
+        _load_daily(refresh=True)
+
+def _load_daily_snapshot():
+    """Fall back to the last on-disk snapshot when Sheets can't be read"""
+    if not os.path.exists(SNAPSHOT_FILE):
+        return False
+    
+    try:
+        with open(SNAPSHOT_FILE) as f:
+            snapshot = json.load(f)
+        
+        daily = defaultdict(lambda: defaultdict(float))
+        for day, totals in snapshot.items():
+            daily[date.fromisoformat(day)].update(totals)
+        
+        _replace_daily(daily)
+        print(f"Loaded daily totals from {SNAPSHOT_FILE}")
+        return True
+    except Exception as e:
+        print(f"Error loading daily snapshot: {e}")
+        return False
+
+def _save_daily_snapshot():
+    """Write the in-memory totals to disk"""
+    if not _daily_loaded:
+        return
+    
+    try:
+        with _daily_lock:
+            snapshot = {day.isoformat(): dict(totals) for day, totals in _daily.items()}
+        # Write then rename so a concurrent load never sees a partial file
+        tmp_file = SNAPSHOT_FILE + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_file, SNAPSHOT_FILE)
+    except Exception as e:
+        print(f"Error saving daily snapshot: {e}")
+
+def _snapshotter():
+    """Periodically snapshot the in-memory totals"""
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        _save_daily_snapshot()
+
+# atexit runs handlers last-in first-out: the final flush in _save_pending
+# can still add categorized rows to the totals, so it must run before the
+# snapshot (and before the category cache is saved)
+atexit.register(_save_daily_snapshot)
+atexit.register(_save_pending)
+threading.Thread(target=_snapshotter, daemon=True).start()
+
+def _refresher():
+    """Load the totals, then pick up edits made directly in the spreadsheet"""
+    while True:
+        _refresh_daily()
+        time.sleep(REFRESH_INTERVAL if _daily_loaded else LOAD_RETRY_INTERVAL)
+
+# Load totals in the background so the first summary doesn't wait on Sheets
+threading.Thread(target=_refresher, daemon=True).start()
+
+# Get summary from the in-memory totals
+def get_summary(period='today'):
+    """Get expense summary for today, the last week or the last month"""
+    try:
+        # Never load on the request thread; the background refresher does that
+        if not _daily_loaded:
+            return [], 0
+        
+        # Number of days to include, counting today
+        days = {'today': 1, 'week': 8, 'month': 31}.get(period, 0)
+        today = datetime.now().date()
+        
         # Calculate totals by category
-        category_totals = {}
+        category_totals = defaultdict(float)
         total = 0
         
-        for record in filtered:
-            try:
-                amount = float(record['Amount'])
-                category = record['Category']
-                
-                if category in category_totals:
+        with _daily_lock:
+            for i in range(days):
+                for category, amount in _daily.get(today - timedelta(days=i), {}).items():
                     category_totals[category] += amount
-                else:
-                    category_totals[category] = amount
-                
-                total += amount
-            except:
-                continue
+                    total += amount
         
-        results = [(cat, amt) for cat, amt in category_totals.items()]
-        return results, total
+        return list(category_totals.items()), total
         
     except Exception as e:
         print(f"Error getting summary: {e}")
         return [], 0
 
+HELP_MSG = """🤖 *Expense Tracker Help*
+
+📝 Add expense:
+• "Lunch 15.50"
+• "Coffee 5.25"
+• "Uber 12"
+
+📊 View summaries:
+• "summary" or "today"
+• "week"
+• "month"
+
+💾 Data stored in Google Sheets
+🤖 AI categorizes automatically!"""
+
+def format_summary(title, results, total, empty_msg):
+    """Format category totals as a WhatsApp message"""
+    lines = [f"• {cat}: ${amt:.2f}" for cat, amt in results]
+    return f"📊 *{title}: ${total:.2f}*\n\n" + ("\n".join(lines) if lines else empty_msg)
+
+# Same envelope Twilio's MessagingResponse produces for a single message
+TWIML_TEMPLATE = '<?xml version="1.0" encoding="UTF-8"?><Response><Message>{body}</Message></Response>'
+
+def twiml(response_msg):
+    """Wrap a reply in a Twilio messaging response"""
+    return Response(TWIML_TEMPLATE.format(body=escape(response_msg)), mimetype='application/xml')
+
 # Twilio webhook endpoint
 @app.route('/webhook', methods=['POST'])
 def webhook():
     """Handle incoming WhatsApp messages"""
-    incoming_msg = request.values.get('Body', '').strip().lower()
+    original_msg = request.values.get('Body', '').strip()
+    incoming_msg = original_msg.lower()
     from_number = request.values.get('From', '')
     
+    # Nothing to parse - answer without touching Gemini or Sheets
+    if len(incoming_msg) < 2:
+        return twiml("❌ Send an expense like 'Lunch 15.50' or 'help' for commands")
+    
     response_msg = ""
     
+    # Summaries come only from memory; say so while the first load is running
+    if incoming_msg in ['summary', 'today', 'week', 'month'] and _CREDS and not _daily_loaded:
+        if sheets_failing():
+            return twiml("❌ Error reading from Google Sheets. Check configuration.")
+        return twiml("⏳ Still loading your expenses from Google Sheets. Try again in a moment.")
+    
     # Check for commands
     if incoming_msg in ['summary', 'today']:
         results, total = get_summary('today')
-        response_msg = f"📊 *Today's Expenses: ${total:.2f}*\n\n"
-        if results:
-            for cat, amt in results:
-                response_msg += f"• {cat}: ${amt:.2f}\n"
-        else:
-            response_msg += "No expenses recorded today."
+        response_msg = format_summary("Today's Expenses", results, total, "No expenses recorded today.")
     
     elif incoming_msg == 'week':
         results, total = get_summary('week')
-        response_msg = f"📊 *This Week: ${total:.2f}*\n\n"
-        if results:
-            for cat, amt in results:
-                response_msg += f"• {cat}: ${amt:.2f}\n"
-        else:
-            response_msg += "No expenses this week."
+        response_msg = format_summary("This Week", results, total, "No expenses this week.")
     
     elif incoming_msg == 'month':
         results, total = get_summary('month')
-        response_msg = f"📊 *This Month: ${total:.2f}*\n\n"
-        if results:
-            for cat, amt in results:
-                response_msg += f"• {cat}: ${amt:.2f}\n"
-        else:
-            response_msg += "No expenses this month."
+        response_msg = format_summary("This Month", results, total, "No expenses this month.")
     
     elif incoming_msg == 'help':
-        response_msg = """🤖 *Expense Tracker Help*
-
-📝 Add expense:
-• "Lunch 15.50"
-• "Coffee 5.25"
-• "Uber 12"
-
-📊 View summaries:
-• "summary" or "today"
-• "week"
-• "month"
-
-💾 Data stored in Google Sheets
-🤖 AI categorizes automatically!"""
+        response_msg = HELP_MSG
     
     else:
         # Try to parse as expense
-        original_msg = request.values.get('Body', '').strip()
         description, amount = parse_expense(original_msg)
         
         if description and amount:
             try:
-                category = categorize_expense(description)
+                category = cached_category(description)
                 success = save_expense(description, amount, category)
                 
                 if success:
-                    response_msg = f"✅ Saved: {description} - ${amount:.2f}\n📁 Category: {category}"
+                    response_msg = f"✅ Saved: {description} - ${amount:.2f}\n📁 Category: {category or '🤖 categorizing...'}"
                 else:
                     response_msg = "❌ Error saving to Google Sheets. Check configuration."
             except Exception as e:
@@ -315,14 +765,7 @@ def webhook():
             response_msg = "❌ I couldn't understand that.\n\nTry:\n• 'Lunch 15.50'\n• 'help' for commands"
     
     # Send response back via Twilio
-    try:
-        from twilio.twiml.messaging_response import MessagingResponse
-        resp = MessagingResponse()
-        resp.message(response_msg)
-        return str(resp)
-    except Exception as e:
-        print(f"Error sending response: {e}")
-        return response_msg
+    return twiml(response_msg)
 
 @app.route('/', methods=['GET'])
 def home():
@@ -350,6 +793,10 @@ def health():
     return {"status": "healthy", "timestamp": datetime.now().isoformat()}
 
 if __name__ == '__main__':
+    # Exit cleanly on SIGTERM so pending expenses are saved
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
+    # Local development only; production runs under gunicorn (see Procfile)
     port = int(os.environ.get('PORT', 10000))
     print(f"Starting server on port {port}...")
-    app.run(host='0.0.0.0', port=port, debug=False)
+    app.run(host='0.0.0.0', port=port, debug=False, threaded=True)